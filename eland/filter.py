@@ -21,17 +21,20 @@ from typing import Dict, Any, List, Optional, Union, cast
 
 
 class BooleanFilter:
+    # Filters are created for every predicate in a query, keep them small
+    __slots__ = ("_filter",)
+
     def __init__(self) -> None:
         self._filter: Dict[str, Any] = {}
 
     def __and__(self, x: "BooleanFilter") -> "BooleanFilter":
-        if tuple(self.subtree.keys()) == ("must",):
+        if self._is_bool_of("must"):
             if "bool" in self._filter:
                 self.subtree["must"].append(x.build())
             else:
                 self.subtree["must"].append(x.subtree)
             return self
-        elif tuple(x.subtree.keys()) == ("must",):
+        elif x._is_bool_of("must"):
             if "bool" in x._filter:
                 x.subtree["must"].append(self.build())
             else:
@@ -40,13 +43,13 @@ class BooleanFilter:
         return AndFilter(self, x)
 
     def __or__(self, x: "BooleanFilter") -> "BooleanFilter":
-        if tuple(self.subtree.keys()) == ("should",):
+        if self._is_bool_of("should"):
             if "bool" in x._filter:
                 self.subtree["should"].append(x.build())
             else:
                 self.subtree["should"].append(x.subtree)
             return self
-        elif tuple(x.subtree.keys()) == ("should",):
+        elif x._is_bool_of("should"):
             if "bool" in self._filter:
                 x.subtree["should"].append(self.build())
             else:
@@ -57,6 +60,11 @@ class BooleanFilter:
     def __invert__(self) -> "BooleanFilter":
         return NotFilter(self)
 
+    def _is_bool_of(self, clause: str) -> bool:
+        # True if the (bool) subtree holds nothing but `clause`
+        subtree = self.subtree
+        return len(subtree) == 1 and clause in subtree
+
     def empty(self) -> bool:
         return not bool(self._filter)
 
@@ -76,18 +84,24 @@ class BooleanFilter:
 
 # Binary operator
 class AndFilter(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, *args: BooleanFilter) -> None:
         super().__init__()
         self._filter = {"bool": {"must": [x.build() for x in args]}}
 
 
 class OrFilter(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, *args: BooleanFilter) -> None:
         super().__init__()
         self._filter = {"bool": {"should": [x.build() for x in args]}}
 
 
 class NotFilter(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, x: BooleanFilter) -> None:
         super().__init__()
         self._filter = {"bool": {"must_not": x.build()}}
@@ -95,36 +109,48 @@ class NotFilter(BooleanFilter):
 
 # LeafBooleanFilter
 class GreaterEqual(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str, value: Any) -> None:
         super().__init__()
         self._filter = {"range": {field: {"gte": value}}}
 
 
 class Greater(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str, value: Any) -> None:
         super().__init__()
         self._filter = {"range": {field: {"gt": value}}}
 
 
 class LessEqual(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str, value: Any) -> None:
         super().__init__()
         self._filter = {"range": {field: {"lte": value}}}
 
 
 class Less(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str, value: Any) -> None:
         super().__init__()
         self._filter = {"range": {field: {"lt": value}}}
 
 
 class Equal(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str, value: Any) -> None:
         super().__init__()
         self._filter = {"term": {field: value}}
 
 
 class IsIn(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str, value: List[Any]) -> None:
         super().__init__()
         if field == "ids":
@@ -134,36 +160,48 @@ class IsIn(BooleanFilter):
 
 
 class Like(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str, value: str) -> None:
         super().__init__()
         self._filter = {"wildcard": {field: value}}
 
 
 class Rlike(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str, value: str) -> None:
         super().__init__()
         self._filter = {"regexp": {field: value}}
 
 
 class Startswith(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str, value: str) -> None:
         super().__init__()
         self._filter = {"prefix": {field: value}}
 
 
 class IsNull(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str) -> None:
         super().__init__()
         self._filter = {"bool": {"must_not": {"exists": {"field": field}}}}
 
 
 class NotNull(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, field: str) -> None:
         super().__init__()
         self._filter = {"exists": {"field": field}}
 
 
 class ScriptFilter(BooleanFilter):
+    __slots__ = ()
+
     def __init__(
         self,
         inline: str,
@@ -180,18 +218,24 @@ class ScriptFilter(BooleanFilter):
 
 
 class QueryFilter(BooleanFilter):
+    __slots__ = ()
+
     def __init__(self, query: Dict[str, Any]) -> None:
         super().__init__()
         self._filter = query
 
 
 class MatchAllFilter(QueryFilter):
+    __slots__ = ()
+
     def __init__(self) -> None:
         super().__init__({"match_all": {}})
 
 
 class RandomScoreFilter(QueryFilter):
-    def __init__(self, query: BooleanFilter, random_state: int) -> None:
+    __slots__ = ()
+
+    def __init__(self, query: BooleanFilter, random_state: Optional[int]) -> None:
         q = MatchAllFilter() if query.empty() else query
 
         seed = {}
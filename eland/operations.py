@@ -668,6 +668,9 @@ class Operations:
         body.composite_agg(
             size=DEFAULT_PAGINATION_SIZE, name="groupby_buckets", dropna=dropna
         )
+        # composite_agg_after_key() updates the agg referenced by this body
+        # in place, so it is built once and reused for every page
+        search_body = body.to_search_body()
 
         def response_generator() -> Generator[List[str], None, List[str]]:
             """
@@ -694,7 +697,7 @@ class Operations:
                 res = query_compiler._client.search(
                     index=query_compiler._index_pattern,
                     size=0,
-                    body=body.to_search_body(),
+                    body=search_body,
                 )
                 # Pagination Logic
                 if "after_key" in res["aggregations"]["groupby_buckets"]:
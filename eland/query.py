@@ -16,94 +16,221 @@
 #  under the License.
 
 import warnings
-from copy import deepcopy
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Tuple
 
 from eland.filter import (
     RandomScoreFilter,
     BooleanFilter,
     NotNull,
-    IsNull,
     IsIn,
     Rlike,
+    QueryFilter,
 )
 
+# Upper bound on the combined size of terms()/ids() item lists that Query
+# merges into a single IsIn filter
+_MAX_MERGED_TERMS = 10000
+
+
+def _copy_agg(agg: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Copy an agg built by Query deep enough to be mutated by Query.
+
+    Query only ever writes to the top two levels of an agg (``missing_bucket``
+    on a terms agg, ``after`` on a composite agg), so this avoids the
+    generality and overhead of ``copy.deepcopy()``.
+    """
+    return {
+        key: value.copy() if isinstance(value, dict) else value
+        for key, value in agg.items()
+    }
+
 
 class Query:
     """
     Simple class to manage building Elasticsearch queries.
     """
 
+    __slots__ = (
+        "_must",
+        "_must_not",
+        "_must_terms",
+        "_must_not_terms",
+        "_random_score",
+        "_random_state",
+        "_aggs",
+        "_term_aggs",
+        "_metric_aggs",
+        "_query_body",
+        "_query_owned",
+        "_aggs_owned",
+    )
+
     def __init__(self, query: Optional["Query"] = None):
         # type defs
-        self._query: BooleanFilter
+        self._must: List[BooleanFilter]
+        self._must_not: List[BooleanFilter]
+        # field -> (index in _must/_must_not, items) of IsIn filters that
+        # later terms()/ids() calls on the same field are merged into
+        self._must_terms: Dict[str, Tuple[int, List[Any]]]
+        self._must_not_terms: Dict[str, Tuple[int, List[Any]]]
+        self._random_score: bool
+        self._random_state: Optional[int]
         self._aggs: Dict[str, Any]
+        # Partition of _aggs into composite sources (terms) and the
+        # aggregations nested under them, maintained as aggs are added
+        self._term_aggs: Dict[str, Any]
+        self._metric_aggs: Dict[str, Any]
+        # Materialized query clause, reset by every filter mutator
+        self._query_body: Optional[Dict[str, Any]]
+        # False while _must/_must_not/_aggs are shared with another Query
+        self._query_owned: bool
+        self._aggs_owned: bool
 
         if query is None:
-            self._query = BooleanFilter()
+            self._must = []
+            self._must_not = []
+            self._must_terms = {}
+            self._must_not_terms = {}
+            self._random_score = False
+            self._random_state = None
+            self._query_body = None
             self._aggs = {}
+            self._term_aggs = {}
+            self._metric_aggs = {}
+            self._query_owned = True
+            self._aggs_owned = True
+        else:
+            # Share the incoming query's state and only copy it on
+            # the first write (from either side) - see _ensure_*_owned()
+            self._must = query._must
+            self._must_not = query._must_not
+            self._must_terms = query._must_terms
+            self._must_not_terms = query._must_not_terms
+            self._random_score = query._random_score
+            self._random_state = query._random_state
+            self._query_body = query._query_body
+            self._aggs = query._aggs
+            self._term_aggs = query._term_aggs
+            self._metric_aggs = query._metric_aggs
+            self._query_owned = False
+            self._aggs_owned = False
+            query._query_owned = False
+            query._aggs_owned = False
+
+    def _ensure_query_owned(self) -> None:
+        # Filters are never mutated once added so copying the lists is enough
+        if not self._query_owned:
+            self._must = self._must.copy()
+            self._must_not = self._must_not.copy()
+            self._must_terms = self._must_terms.copy()
+            self._must_not_terms = self._must_not_terms.copy()
+            self._query_owned = True
+
+    def _ensure_aggs_owned(self) -> None:
+        if not self._aggs_owned:
+            self._aggs = {name: _copy_agg(agg) for name, agg in self._aggs.items()}
+            # Re-point the partitions at the copied agg dicts
+            self._term_aggs = {name: self._aggs[name] for name in self._term_aggs}
+            self._metric_aggs = {name: self._aggs[name] for name in self._metric_aggs}
+            self._aggs_owned = True
+
+    def _add_agg(self, name: str, agg: Dict[str, Any]) -> None:
+        self._ensure_aggs_owned()
+        self._aggs[name] = agg
+        if "terms" in agg:
+            self._metric_aggs.pop(name, None)
+            self._term_aggs[name] = agg
         else:
-            # Deep copy the incoming query so we can change it
-            self._query = deepcopy(query._query)
-            self._aggs = deepcopy(query._aggs)
+            self._term_aggs.pop(name, None)
+            self._metric_aggs[name] = agg
 
     def exists(self, field: str, must: bool = True) -> None:
         """
         Add exists query
         https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-exists-query.html
         """
+        self._ensure_query_owned()
+        self._query_body = None
         if must:
-            if self._query.empty():
-                self._query = NotNull(field)
-            else:
-                self._query = self._query & NotNull(field)
+            self._must.append(NotNull(field))
         else:
-            if self._query.empty():
-                self._query = IsNull(field)
-            else:
-                self._query = self._query & IsNull(field)
+            self._must_not.append(NotNull(field))
 
     def ids(self, items: List[Any], must: bool = True) -> None:
         """
         Add ids query
         https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-ids-query.html
         """
-        if must:
-            if self._query.empty():
-                self._query = IsIn("ids", items)
-            else:
-                self._query = self._query & IsIn("ids", items)
-        else:
-            if self._query.empty():
-                self._query = ~(IsIn("ids", items))
-            else:
-                self._query = self._query & ~(IsIn("ids", items))
+        self._add_terms("ids", items, must)
 
     def terms(self, field: str, items: List[str], must: bool = True) -> None:
         """
         Add ids query
         https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-terms-query.html
         """
+        self._add_terms(field, items, must)
+
+    def _add_terms(self, field: str, items: List[Any], must: bool) -> None:
+        """
+        Add an IsIn filter, folding it into an earlier one on the same field
+        where that is equivalent: must_not terms are unioned, and must ids
+        are intersected. must terms on other fields are kept separate as a
+        multi-valued field can match each of them with a different value.
+        """
+        self._ensure_query_owned()
+        self._query_body = None
+
         if must:
-            if self._query.empty():
-                self._query = IsIn(field, items)
-            else:
-                self._query = self._query & IsIn(field, items)
+            filters, merged = self._must, self._must_terms
         else:
-            if self._query.empty():
-                self._query = ~(IsIn(field, items))
-            else:
-                self._query = self._query & ~(IsIn(field, items))
+            filters, merged = self._must_not, self._must_not_terms
+
+        if field in merged:
+            index, prev_items = merged[field]
+            # Merging very large lists costs more than ES evaluating both
+            if len(prev_items) + len(items) <= _MAX_MERGED_TERMS:
+                if must:
+                    keep = set(items)
+                    new_items = [x for x in prev_items if x in keep]
+                else:
+                    new_items = list(dict.fromkeys([*prev_items, *items]))
+                filters[index] = IsIn(field, new_items)
+                merged[field] = (index, new_items)
+                return
+        elif not must or field == "ids":
+            merged[field] = (len(filters), items)
+
+        filters.append(IsIn(field, items))
 
     def regexp(self, field: str, value: str) -> None:
         """
         Add regexp query
         https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-regexp-query.html
         """
-        if self._query.empty():
-            self._query = Rlike(field, value)
-        else:
-            self._query = self._query & Rlike(field, value)
+        self._ensure_query_owned()
+        self._query_body = None
+        self._must.append(Rlike(field, value))
+
+    def add_raw_must(self, clause: Dict[str, Any]) -> None:
+        """
+        Add an already built query clause that documents must match e.g.
+
+        {"terms": {"Airline": ["Kibana Airlines", "JetBeats"]}}
+        """
+        self._ensure_query_owned()
+        self._query_body = None
+        self._must.append(QueryFilter(clause))
+
+    def add_raw_must_not(self, clause: Dict[str, Any]) -> None:
+        """
+        Add an already built query clause that documents must not match e.g.
+
+        {"exists": {"field": "Cancelled"}}
+        """
+        self._ensure_query_owned()
+        self._query_body = None
+        self._must_not.append(QueryFilter(clause))
 
     def terms_aggs(self, name: str, func: str, field: str, es_size: int) -> None:
         """
@@ -118,8 +245,7 @@ class Query:
             }
         }
         """
-        agg = {func: {"field": field, "size": es_size}}
-        self._aggs[name] = agg
+        self._add_agg(name, {func: {"field": field, "size": es_size}})
 
     def metric_aggs(self, name: str, func: str, field: str) -> None:
         """
@@ -133,8 +259,7 @@ class Query:
             }
         }
         """
-        agg = {func: {"field": field}}
-        self._aggs[name] = agg
+        self._add_agg(name, {func: {"field": field}})
 
     def term_aggs(self, name: str, field: str) -> None:
         """
@@ -148,8 +273,7 @@ class Query:
             }
         }
         """
-        agg = {"terms": {"field": field}}
-        self._aggs[name] = agg
+        self._add_agg(name, {"terms": {"field": field}})
 
     def composite_agg(
         self,
@@ -189,28 +313,31 @@ class Query:
             TODO Not yet implemented
 
         """
-        sources: List[Dict[str, Dict[str, str]]] = []
-        aggregations: Dict[str, Dict[str, str]] = {}
+        self._ensure_aggs_owned()
+        if not dropna:
+            for agg in self._term_aggs.values():
+                agg["terms"]["missing_bucket"] = "true"
 
-        for _name, agg in self._aggs.items():
-            if agg.get("terms"):
-                if not dropna:
-                    agg["terms"]["missing_bucket"] = "true"
-                sources.append({_name: agg})
-            else:
-                aggregations[_name] = agg
+        sources: List[Dict[str, Dict[str, str]]] = [
+            {_name: agg} for _name, agg in self._term_aggs.items()
+        ]
 
         agg = {
             "composite": {"size": size, "sources": sources},
-            "aggregations": aggregations,
+            "aggregations": self._metric_aggs,
         }
-        self._aggs.clear()
-        self._aggs[name] = agg
+        self._aggs = {name: agg}
+        self._term_aggs = {}
+        self._metric_aggs = {}
 
     def composite_agg_after_key(self, name: str, after_key: Dict[str, Any]) -> None:
         """
         Add's after_key to existing query to fetch next bunch of results
 
+        The composite agg is updated in place, so search bodies already
+        returned by to_search_body() pick up the new after_key too (unless
+        this Query has been copied since).
+
         PARAMETERS
         ----------
         name: str
@@ -218,6 +345,7 @@ class Query:
         after_key: Dict[str, Any]
             Dictionary returned from previous query results
         """
+        self._ensure_aggs_owned()
         self._aggs[name]["composite"]["after"] = after_key
 
     def hist_aggs(
@@ -240,39 +368,98 @@ class Query:
             }
         }
         """
+        # A constant field has no meaningful bins, skip it
+        if max_value == min_value or num_bins <= 0:
+            return
 
         interval = (max_value - min_value) / num_bins
+        # A tiny (e.g. subnormal) span can still underflow to zero
+        if interval == 0:
+            return
 
-        if interval != 0:
-            agg = {
-                "histogram": {"field": field, "interval": interval, "offset": min_value}
-            }
-            self._aggs[name] = agg
+        self._add_agg(
+            name,
+            {"histogram": {"field": field, "interval": interval, "offset": min_value}},
+        )
+
+    def _build_query(self) -> Optional[Dict[str, Any]]:
+        """
+        Materialize the accumulated filters into a single query clause,
+        or None if there is nothing to filter on.
+
+        The clause is cached until the next filter mutation so repeated
+        serialization (e.g. composite aggregation pagination) is free.
+        """
+        if self._query_body is not None:
+            return self._query_body
+
+        query: BooleanFilter
+        if len(self._must) == 1 and not self._must_not:
+            query = self._must[0]
+        elif self._must or self._must_not:
+            bool_query: Dict[str, List[Dict[str, Any]]] = {}
+            if self._must:
+                bool_query["must"] = [x.build() for x in self._must]
+            if self._must_not:
+                bool_query["must_not"] = [x.build() for x in self._must_not]
+            query = QueryFilter({"bool": bool_query})
+        elif self._random_score:
+            # RandomScoreFilter scores an empty filter against match_all
+            query = BooleanFilter()
+        else:
+            # Nothing to filter on - the common case for plain aggs
+            return None
+
+        if self._random_score:
+            query = RandomScoreFilter(query, self._random_state)
+
+        if query.empty():
+            return None
+        self._query_body = query.build()
+        return self._query_body
 
     def to_search_body(self) -> Dict[str, Any]:
-        body = {}
-        if self._aggs:
-            body["aggs"] = self._aggs
-        if not self._query.empty():
-            body["query"] = self._query.build()
-        return body
+        # Callers add keys (e.g. script_fields, _source) to the returned
+        # body, so build a fresh top-level dict each time - but in one go
+        # for each shape rather than filling in an empty dict
+        query = self._build_query()
+        if not self._aggs:
+            return {} if query is None else {"query": query}
+        if query is None:
+            return {"aggs": self._aggs}
+        return {"aggs": self._aggs, "query": query}
 
     def to_count_body(self) -> Optional[Dict[str, Any]]:
         if len(self._aggs) > 0:
-            warnings.warn(f"Requesting count for agg query {self}")
-        if self._query.empty():
+            # Only name the aggs - formatting {self} would serialize the
+            # whole body even when the warning is filtered out
+            warnings.warn(
+                f"Requesting count for agg query with aggs {list(self._aggs)}"
+            )
+        query = self._build_query()
+        if query is None:
             return None
         else:
-            return {"query": self._query.build()}
+            return {"query": query}
 
     def update_boolean_filter(self, boolean_filter: BooleanFilter) -> None:
-        if self._query.empty():
-            self._query = boolean_filter
-        else:
-            self._query = self._query & boolean_filter
+        # An empty filter matches everything, and would otherwise be
+        # serialized as a literal {} clause that Elasticsearch rejects
+        if boolean_filter.empty():
+            return
+        self._ensure_query_owned()
+        self._query_body = None
+        self._must.append(boolean_filter)
 
     def random_score(self, random_state: int) -> None:
-        self._query = RandomScoreFilter(self._query, random_state)
+        # The function_score wrapper is applied in _build_query()
+        self._random_score = True
+        self._random_state = random_state
+        self._query_body = None
 
     def __repr__(self) -> str:
-        return repr(self.to_search_body())
+        # Cheap summary, use to_search_body() to see the full request body
+        return (
+            f"Query(must={len(self._must)}, must_not={len(self._must_not)}, "
+            f"aggs={len(self._aggs)})"
+        )
@@ -17,6 +17,7 @@
 
 # File called _pytest for PyCharm compatability
 
+from eland.filter import BooleanFilter, QueryFilter
 from eland.query import Query
 from eland.tests.common import TestData
 
@@ -37,3 +38,208 @@ class TestQueryCopy(TestData):
 
         print(q.to_search_body())
         print(q1.to_search_body())
+
+    def test_copy_on_write(self):
+        q = Query()
+        q.exists("field_a")
+        q.terms_aggs("terms_a", "terms", "field_a", 10)
+
+        q1 = Query(q)
+        assert q1.to_search_body() == q.to_search_body()
+
+        q1.exists("field_b")
+        q1.metric_aggs("max_b", "max", "field_b")
+        assert q.to_search_body() == {
+            "aggs": {"terms_a": {"terms": {"field": "field_a", "size": 10}}},
+            "query": {"exists": {"field": "field_a"}},
+        }
+
+        # Writes to the original must not leak into the copy either
+        q2 = Query(q)
+        q.exists("field_c")
+        q.composite_agg("buckets", size=10, dropna=False)
+        assert q2.to_search_body() == {
+            "aggs": {"terms_a": {"terms": {"field": "field_a", "size": 10}}},
+            "query": {"exists": {"field": "field_a"}},
+        }
+
+    def test_copy_composite_after_key(self):
+        q = Query()
+        q.term_aggs("groupby_a", "field_a")
+        q.metric_aggs("avg_b", "avg", "field_b")
+        q.composite_agg("buckets", size=10, dropna=False)
+
+        q1 = Query(q)
+        q1.composite_agg_after_key("buckets", {"groupby_a": "x"})
+        assert "after" not in q.to_search_body()["aggs"]["buckets"]["composite"]
+        assert q1.to_search_body()["aggs"]["buckets"]["composite"]["after"] == {
+            "groupby_a": "x"
+        }
+
+
+class TestQuery:
+    def test_flat_bool_query(self):
+        q = Query()
+        q.exists("field_a")
+        assert q.to_count_body() == {"query": {"exists": {"field": "field_a"}}}
+
+        q.exists("field_b", must=False)
+        q.terms("field_c", ["x", "y"])
+        q.ids(["1"], must=False)
+        assert q.to_search_body() == {
+            "query": {
+                "bool": {
+                    "must": [
+                        {"exists": {"field": "field_a"}},
+                        {"terms": {"field_c": ["x", "y"]}},
+                    ],
+                    "must_not": [
+                        {"exists": {"field": "field_b"}},
+                        {"ids": {"values": ["1"]}},
+                    ],
+                }
+            }
+        }
+
+        q.random_score(42)
+        assert q.to_search_body()["query"]["function_score"]["random_score"] == {
+            "seed": 42,
+            "field": "_seq_no",
+        }
+
+    def test_query_body_cache(self):
+        q = Query()
+        q.exists("field_a")
+        q.exists("field_b")
+        q.composite_agg("buckets", size=10)
+
+        body = q.to_search_body()
+        q.composite_agg_after_key("buckets", {"field_a": 1})
+        assert q.to_search_body()["query"] is body["query"]
+        assert body["aggs"]["buckets"]["composite"]["after"] == {"field_a": 1}
+
+        q.exists("field_c", must=False)
+        assert q.to_search_body()["query"] == {
+            "bool": {
+                "must": [
+                    {"exists": {"field": "field_a"}},
+                    {"exists": {"field": "field_b"}},
+                ],
+                "must_not": [{"exists": {"field": "field_c"}}],
+            }
+        }
+
+    def test_composite_agg(self):
+        q = Query()
+        q.term_aggs("groupby_a", "field_a")
+        q.metric_aggs("avg_b", "avg", "field_b")
+        q.term_aggs("groupby_c", "field_c")
+
+        q1 = Query(q)
+        q1.composite_agg("buckets", size=10, dropna=False)
+        q.composite_agg("buckets", size=10)
+
+        assert q1.to_search_body() == {
+            "aggs": {
+                "buckets": {
+                    "composite": {
+                        "size": 10,
+                        "sources": [
+                            {
+                                "groupby_a": {
+                                    "terms": {
+                                        "field": "field_a",
+                                        "missing_bucket": "true",
+                                    }
+                                }
+                            },
+                            {
+                                "groupby_c": {
+                                    "terms": {
+                                        "field": "field_c",
+                                        "missing_bucket": "true",
+                                    }
+                                }
+                            },
+                        ],
+                    },
+                    "aggregations": {"avg_b": {"avg": {"field": "field_b"}}},
+                }
+            }
+        }
+        assert q.to_search_body()["aggs"]["buckets"]["composite"]["sources"] == [
+            {"groupby_a": {"terms": {"field": "field_a"}}},
+            {"groupby_c": {"terms": {"field": "field_c"}}},
+        ]
+
+    def test_raw_clauses(self):
+        q = Query()
+        q.add_raw_must({"match": {"field_a": "x"}})
+        assert q.to_search_body() == {"query": {"match": {"field_a": "x"}}}
+
+        q.add_raw_must_not({"ids": {"values": ["1", "2"]}})
+        assert q.to_search_body() == {
+            "query": {
+                "bool": {
+                    "must": [{"match": {"field_a": "x"}}],
+                    "must_not": [{"ids": {"values": ["1", "2"]}}],
+                }
+            }
+        }
+
+    def test_merge_terms(self):
+        q = Query()
+        q.ids(["1", "2", "3"])
+        q.terms("field_a", ["x"])
+        q.terms("field_a", ["y"])
+        q.ids(["2", "3", "4"])
+        q.terms("field_b", ["x"], must=False)
+        q.terms("field_b", ["x", "y"], must=False)
+
+        assert q.to_search_body() == {
+            "query": {
+                "bool": {
+                    "must": [
+                        {"ids": {"values": ["2", "3"]}},
+                        {"terms": {"field_a": ["x"]}},
+                        {"terms": {"field_a": ["y"]}},
+                    ],
+                    "must_not": [{"terms": {"field_b": ["x", "y"]}}],
+                }
+            }
+        }
+
+    def test_empty_boolean_filter(self):
+        q = Query()
+        q.update_boolean_filter(BooleanFilter())
+        assert q.to_search_body() == {}
+
+        q.update_boolean_filter(QueryFilter({}))
+        q.exists("field_a")
+        q.exists("field_b")
+        assert q.to_search_body() == {
+            "query": {
+                "bool": {
+                    "must": [
+                        {"exists": {"field": "field_a"}},
+                        {"exists": {"field": "field_b"}},
+                    ]
+                }
+            }
+        }
+
+    def test_hist_aggs(self):
+        q = Query()
+        q.hist_aggs("constant", "field_a", 5, 5, 10)
+        q.hist_aggs("no_bins", "field_a", 0, 10, 0)
+        q.hist_aggs("underflow", "field_a", 0.0, 5e-324, 10)
+        assert q.to_search_body() == {}
+
+        q.hist_aggs("hist_a", "field_a", 0, 10, 5)
+        assert q.to_search_body() == {
+            "aggs": {
+                "hist_a": {
+                    "histogram": {"field": "field_a", "interval": 2.0, "offset": 0}
+                }
+            }
+        }